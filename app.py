@@ -1,13 +1,19 @@
 import os
+import logging
+from collections import deque
 import streamlit as st
 from dotenv import load_dotenv
-from src.agent_response import chat_with_agent
-from src.data_loader import load_chat_data, load_policy_docs
-from src.embedding_index import build_or_load_index
+from src.agent_response import HISTORY_WINDOW, chat_with_agent
+from src.embedding_index import load_index_for_sources
+from src.rate_limiter import make_llm_limiter
 
 # Load environment variables (e.g., OpenAI API key)
 load_dotenv()
 
+# Debug traces are emitted via logging; set LOG_LEVEL=DEBUG to see them
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
 # Safe Streamlit secrets access (avoid exception if no secrets file locally)
 if not os.getenv("OPENAI_API_KEY"):
     try:
@@ -33,24 +39,55 @@ st.caption("Ask underwriting questions. The system references broker chats + pol
 
 @st.cache_resource(show_spinner="Building vector index (first run)...")
 def get_index():
-    chat_data = load_chat_data("data/chat_data/chat_data.xlsx")
-    policy_docs = load_policy_docs("data/policy_documents")
-    return build_or_load_index(chat_data, policy_docs)
+    # Reuses the persisted index for unchanged sources; only parses/embeds when something changed
+    return load_index_for_sources("data/chat_data/chat_data.xlsx", "data/policy_documents")
+
+@st.cache_resource
+def get_llm_limiter():
+    # One bucket shared by every session in this process
+    return make_llm_limiter()
 
 # Initialize chat history in session state if not already present
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-    print("[DEBUG] Initialized chat_history in session state")  # Debug: Session state init
+    logger.debug("Initialized chat_history in session state")
+if "llm_history" not in st.session_state:
+    # What the agent may look back at: raw messages, bounded so it never needs trimming
+    st.session_state.llm_history = deque(maxlen=HISTORY_WINDOW)
+
+def _role(speaker):
+    return "user" if "Broker" in speaker else "assistant"
+
+def _for_display(text):
+    # Markdown hard line breaks; done once on append rather than on every rerun
+    return text.replace("\n", "  \n")
+
+# Replay the conversation so far; only the new turn below is rendered incrementally
+for speaker, msg in st.session_state.chat_history:
+    with st.chat_message(_role(speaker)):
+        st.markdown(msg)
 
 # Input box for user to ask a question
-user_input = st.text_input("Ask a question about underwriting, coverage, or policy:")
+user_input = st.chat_input("Ask a question about underwriting, coverage, or policy:")
 debug = st.sidebar.checkbox("Show debug traces", value=False)
 if user_input:
-    st.session_state.chat_history.append(("🧑 Broker", user_input))
-    with st.spinner("Thinking..."):
+    st.session_state.chat_history.append(("🧑 Broker", _for_display(user_input)))
+    with st.chat_message("user"):
+        st.markdown(user_input)
+    with st.chat_message("assistant"):
+        response = None
         try:
-            _ = get_index()  # build / load once
-            response = chat_with_agent(user_input)
+            with st.spinner("Thinking..."):
+                index = get_index()  # build / load once
+                stream = chat_with_agent(
+                    user_input,
+                    history=st.session_state.llm_history,  # turns before this question
+                    index=index,
+                    stream=True,
+                    limiter=get_llm_limiter(),
+                )
+            # Render tokens as they arrive
+            response = st.write_stream(stream)
         except Exception as e:
             import traceback, textwrap
             tb = traceback.format_exc()
@@ -60,12 +97,9 @@ if user_input:
                 st.code(tb, language="text")
             response = msg
         finally:
-            st.session_state.chat_history.append(("🤖 Agent", response))
-
-# Display the chat history
-with st.container():
-    for speaker, msg in st.session_state.chat_history:
-        st.markdown(f"**{speaker}:** {msg}")
+            st.session_state.chat_history.append(("🤖 Agent", _for_display(str(response))))
+            st.session_state.llm_history.append(("🧑 Broker", user_input))
+            st.session_state.llm_history.append(("🤖 Agent", str(response)))
 
 st.sidebar.header("Settings")
 st.sidebar.write("Adjust chunking via env vars: CHUNK_SIZE, CHUNK_OVERLAP, MIN_CHUNK_CHARS.")
@@ -1,6 +1,7 @@
 import pandas as pd
 import re
 import os
+import logging
 from langchain.schema import Document
 
 
@@ -8,37 +9,45 @@ from langchain_core.documents import Document
 import pandas as pd
 import re
 
-def load_chat_data(chat_excel_path):
-    df = pd.read_excel(chat_excel_path)
-    all_docs = []
+logger = logging.getLogger(__name__)
+
+# Compiled once; pandas str kernels accept compiled patterns directly
+_TAG_RE = re.compile(r'<.*?>')
+# Timestamped transcript line: "HH:MM:SS - sender - message" (one per line)
+_TS_RE = re.compile(r'^\d{2}:\d{2}:\d{2} - (?P<sender>.*?) - (?P<message>.*)', re.MULTILINE)
 
-    for _, row in df.iterrows():
-        transcript = row.get('TRANSCRIPT', '')
-        if pd.isna(transcript):
-            continue
+# Excel column -> Document metadata key
+_METADATA_COLUMNS = {
+    "EXPERIENCE": "experience",
+    "INITIAL ROUTING GROUP": "initial_group",
+    "FINAL ROUTING GROUP": "final_group",
+    "OUTCOME": "outcome",
+}
 
-        transcript_clean = re.sub(r'<.*?>', '', str(transcript))
-        lines = transcript_clean.strip().split('\n')
-        messages = []
+def load_chat_data(chat_excel_path):
+    df = pd.read_excel(chat_excel_path)
+    if 'TRANSCRIPT' not in df.columns:
+        return []
 
-        for line in lines:
-            match = re.match(r'\d{2}:\d{2}:\d{2} - (.*?) - (.*)', line)
-            if match:
-                sender, message = match.groups()
-                if sender.strip():
-                    messages.append(f"{sender.strip()}: {message.strip()}")
+    # Strip markup and pull every (sender, message) pair out of all transcripts in one vectorized pass
+    transcripts = df['TRANSCRIPT'].dropna().astype(str).str.replace(_TAG_RE, '', regex=True).str.strip()
+    # extractall reports empty captures as NaN (e.g. "HH:MM:SS -  - Welcome" system lines); restore ""
+    parts = transcripts.str.extractall(_TS_RE).fillna("")
+    senders = parts['sender'].str.strip()
+    keep = senders != ""
+    lines = senders[keep] + ": " + parts.loc[keep, 'message'].str.strip()
 
-        chat_text = "\n".join(messages)
-        metadata = {
-            "experience": row.get("EXPERIENCE", ""),
-            "initial_group": row.get("INITIAL ROUTING GROUP", ""),
-            "final_group": row.get("FINAL ROUTING GROUP", ""),
-            "outcome": row.get("OUTCOME", "")
-        }
+    # Re-join messages per transcript row; rows with no matching lines keep an empty chat
+    chat_texts = lines.groupby(level=0).agg("\n".join).reindex(transcripts.index, fill_value="")
 
-        all_docs.append(Document(page_content=chat_text, metadata=metadata))
+    metadata = (
+        df.reindex(columns=list(_METADATA_COLUMNS), fill_value="")
+        .loc[transcripts.index]
+        .rename(columns=_METADATA_COLUMNS)
+        .to_dict("records")
+    )
 
-    return all_docs
+    return [Document(page_content=text, metadata=meta) for text, meta in zip(chat_texts, metadata)]
 
 
 # Test it independently
@@ -46,7 +55,7 @@ def test_load_chat_data():
     test_path = "data/chat_data/chat_data.xlsx"  # adjust path if needed
 
     if not os.path.exists(test_path):
-        print(f"File not found: {test_path}")
+        logger.warning("File not found: %s", test_path)
         return
 
     documents = load_chat_data(test_path)
@@ -54,14 +63,16 @@ def test_load_chat_data():
     assert isinstance(documents, list), "Returned value should be a list."
     assert all(isinstance(doc, Document) for doc in documents), "All elements should be Document instances."
 
-    # Print first few entries for visual inspection
-    for i, doc in enumerate(documents[:3]):
-        print(f"\n--- Document {i+1} ---")
-        print("Content:\n", doc.page_content[:500], "...\n")  # Print only the first 500 chars
-        print("Metadata:", doc.metadata)
+    # Log first few entries for visual inspection
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, doc in enumerate(documents[:3]):
+            logger.debug("--- Document %d ---", i + 1)
+            logger.debug("Content:\n%s ...", doc.page_content[:500])  # Only the first 500 chars
+            logger.debug("Metadata: %s", doc.metadata)
 
-    print("\n✅ Test passed: All documents loaded correctly.")
+    logger.info("✅ Test passed: All documents loaded correctly.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
     test_load_chat_data()
 
@@ -1,23 +1,69 @@
 import os
-import time
+import re
+import hashlib
+import logging
+import functools
+import itertools
+import numpy as np
+import tiktoken
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 from langchain_openai import ChatOpenAI
-from src.data_loader import load_chat_data, load_policy_docs
-from src.embedding_index import build_or_load_index
+from src import embedding_index
+from src.embedding_index import load_index_for_sources
+from src.rate_limiter import make_llm_limiter
+from src.rerank import mmr
+from src.query_cache import LRUCache, SemanticCache
 
 MODEL_NAME = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 EMBED_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
 
-_last_call_ts = 0.0
-_min_call_interval = float(os.getenv("MIN_LLM_INTERVAL", 1.0))  # seconds
+logger = logging.getLogger(__name__)
+
+# Retrieval / prompt-size knobs
+TOP_K = int(os.getenv("TOP_K", 6))                     # docs passed to the LLM
+FETCH_K = int(os.getenv("FETCH_K", 30))                # candidates considered by MMR
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.5))       # 1.0 = pure relevance, 0.0 = pure diversity
+MAX_CTX_CHARS = int(os.getenv("MAX_CTX_CHARS", 8000))  # hard cap on prompt context size
+
+# Conversation memory: look back at most MAX_HISTORY_TURNS exchanges, keep the HISTORY_TOP_N
+# messages most similar to the current question
+MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", 6))
+HISTORY_TOP_N = int(os.getenv("HISTORY_TOP_N", 4))
+# Drop kept messages scoring below this cosine similarity; 0 keeps the top-N regardless. With a
+# threshold, an unrelated follow-up selects no history and can be answered from the caches.
+HISTORY_MIN_SIMILARITY = float(os.getenv("HISTORY_MIN_SIMILARITY", 0.0))
+HISTORY_WINDOW = 2 * MAX_HISTORY_TURNS  # messages; size callers' deque(maxlen=...) with this
+
+# Token budget: history only gets what's left of the model window after the prompt, context,
+# question and room for the answer
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", 16385))
+RESPONSE_TOKEN_RESERVE = int(os.getenv("RESPONSE_TOKEN_RESERVE", 512))
+
+# Speaker tag (as stored by app.py) -> label used in the prompt
+_SPEAKER_LABELS = {"🧑 Broker": "Broker", "Broker": "Broker", "🤖 Agent": "Agent", "Agent": "Agent"}
+
+# Repeat-query caches: exact (normalized query + history) and semantic (near-identical questions)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1000))            # 0 disables
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.97))  # cosine similarity
+
+_response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+_semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+# Unit vectors of recent history messages, so each message is embedded once per process
+HISTORY_VECTOR_CACHE_SIZE = int(os.getenv("HISTORY_VECTOR_CACHE_SIZE", 1024))
+_history_vectors = LRUCache(HISTORY_VECTOR_CACHE_SIZE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Process-wide default; callers (e.g. app.py) may pass their own shared limiter
+_llm_limiter = make_llm_limiter()
 
 # Prompt template for LLM decision inference
 DECISION_PROMPT_TEMPLATE = """
 You are an AI underwriting assistant for small business insurance.
 You have access to the following context from previous broker chats and policy documents:
 {context}
-
+{history}
 Given this information and the broker's question:
 {question}
 
@@ -33,50 +79,224 @@ Decision:
 Explanation:
 """
 
-def chat_with_agent(query):
-    global _last_call_ts
-    now = time.time()
-    if now - _last_call_ts < _min_call_interval:
-        time.sleep(_min_call_interval - (now - _last_call_ts))
-    _last_call_ts = time.time()
-    # Load chat history data from Excel file
-    chat_data = load_chat_data("data/chat_data/chat_data.xlsx")
-    print(f"[DEBUG] Loaded {len(chat_data)} chat documents")  # Debug: Number of chat docs loaded
+EMPTY_QUERY_RESPONSE = "Please enter a question about underwriting, coverage, or policy."
+
+CHAT_DATA_PATH = "data/chat_data/chat_data.xlsx"
+POLICY_DOCS_PATH = "data/policy_documents"
+
+@functools.lru_cache(maxsize=1)
+def _get_index():
+    # Load (or build) once per process; every query afterwards reuses the same vectorstore
+    index = load_index_for_sources(CHAT_DATA_PATH, POLICY_DOCS_PATH)
+    logger.debug("Index built or loaded successfully")
+    return index
+
+@functools.lru_cache(maxsize=1)
+def _get_llm():
+    # Deterministic output (temperature=0); one client (and its HTTP pool) per process
+    return ChatOpenAI(temperature=0, model_name=MODEL_NAME)
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    # Building the BPE tables is slow; do it once per process
+    try:
+        return tiktoken.encoding_for_model(MODEL_NAME)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def _count_tokens(text):
+    return len(_get_encoder().encode(text))
+
+def _normalize_query(query):
+    return _WHITESPACE_RE.sub(" ", query.strip().lower())
+
+@functools.lru_cache(maxsize=512)
+def _query_vector(index, query):
+    # One embedding round-trip per distinct normalized query; shared by retrieval and the semantic cache
+    qvec = np.asarray(index.embeddings.embed_query(query), dtype=np.float32)
+    qvec /= np.linalg.norm(qvec) + 1e-12  # the index stores unit vectors and ranks by inner product
+    qvec.flags.writeable = False
+    return qvec
+
+@functools.lru_cache(maxsize=512)
+def _retrieve(index, query):
+    """ANN-fetch FETCH_K candidates, then pick a diverse TOP_K with the compiled MMR reranker."""
+    qvec = _query_vector(index, query)
+    # Searches the trained index and the delta of documents added since, merged by score
+    ids, dvecs = embedding_index.search_with_vectors(index, qvec, FETCH_K)
+    if not len(ids):
+        return []
+    order = mmr(qvec, dvecs, lam=MMR_LAMBDA, k=TOP_K)
+    return [index.docstore.search(index.index_to_docstore_id[ids[j]]) for j in order]
+
+def _build_context(docs):
+    """Join retrieved docs in rank order, stopping once MAX_CTX_CHARS is reached."""
+    parts = []
+    total_chars = 0
+    for doc in docs:
+        remaining = MAX_CTX_CHARS - total_chars
+        if remaining <= 0:
+            break
+        text = doc.page_content[:remaining]
+        parts.append(text)
+        total_chars += len(text) + 2  # account for the "\n\n" separator
+    return "\n\n".join(parts)
 
-    # Load policy documents from the specified folder
-    policy_docs = load_policy_docs("data/policy_documents")
-    print(f"[DEBUG] Loaded {len(policy_docs)} policy documents")  # Debug: Number of policy docs loaded
+def add_documents(docs):
+    """Append `docs` to the live index and drop cached retrievals/answers that predate them."""
+    ids = embedding_index.add_documents(docs)
+    _retrieve.cache_clear()
+    _response_cache.clear()
+    _semantic_cache.clear()
+    return ids
 
-    # Build or load the FAISS vector index using chat and policy docs
-    index = build_or_load_index(chat_data, policy_docs)
-    print("[DEBUG] Index built or loaded successfully")  # Debug: Index status
+def _embed_history(messages, embeddings):
+    """Unit vectors for `messages`, only embedding those not in the in-process LRU."""
+    keys = [hashlib.sha1(msg.encode("utf-8")).hexdigest() for msg in messages]
+    vecs = [_history_vectors.get(k) for k in keys]
+    missing = [i for i, v in enumerate(vecs) if v is None]
+    if missing:
+        fresh = np.asarray(embeddings.embed_documents([messages[i] for i in missing]), dtype=np.float32)
+        fresh /= np.linalg.norm(fresh, axis=1, keepdims=True) + 1e-12
+        for i, v in zip(missing, fresh):
+            _history_vectors.put(keys[i], v)
+            vecs[i] = v
+    return np.vstack(vecs)
 
-    # Initialize the OpenAI chat model with deterministic output (temperature=0)
-    llm = ChatOpenAI(temperature=0, model_name=MODEL_NAME)
-    print("[DEBUG] ChatOpenAI model initialized")  # Debug: LLM status
+def _select_history(history, qvec, index):
+    """Bound history to a sliding window, then keep only the turns most relevant to query vector `qvec`."""
+    if not history or MAX_HISTORY_TURNS <= 0:
+        return []
+    # islice works for lists and bounded deques alike without copying the whole history
+    window = list(itertools.islice(history, max(0, len(history) - HISTORY_WINDOW), None))
+    if len(window) <= HISTORY_TOP_N and HISTORY_MIN_SIMILARITY <= 0:
+        return window
+    embeddings = index.embeddings
+    if embeddings is None:
+        return window[-HISTORY_TOP_N:]
 
-    # Create a retriever from the index for semantic search
-    retriever = index.as_retriever()
-    print("[DEBUG] Retriever created from index")  # Debug: Retriever status
+    # Cosine similarity of each turn against the question, using the index's own embedding model
+    try:
+        vecs = _embed_history([msg for _, msg in window], embeddings)
+    except Exception as e:
+        logger.warning("Could not embed history (%s); keeping the most recent turns.", e)
+        return window[-HISTORY_TOP_N:]
+    scores = vecs @ (qvec / (np.linalg.norm(qvec) + 1e-12))
+    # top-N above the threshold, back in chronological order
+    keep = sorted(i for i in np.argsort(scores)[-HISTORY_TOP_N:] if scores[i] >= HISTORY_MIN_SIMILARITY)
+    return [window[i] for i in keep]
+
+def _fit_history(turns, budget):
+    """Drop the oldest turns until the rest fit in `budget` tokens."""
+    costs = [_count_tokens(msg) for _, msg in turns]
+    start, total = 0, sum(costs)
+    while start < len(turns) and total > budget:
+        total -= costs[start]
+        start += 1
+    if start:
+        logger.debug("Dropped %d history message(s) to fit %d-token budget", start, budget)
+    return turns[start:]
+
+def _build_history_block(turns):
+    if not turns:
+        return ""
+    lines = [f"{_SPEAKER_LABELS.get(speaker, 'Agent')}: {msg}" for speaker, msg in turns]
+    return "\nRelevant earlier conversation with this broker:\n" + "\n".join(lines) + "\n"
+
+def _remember(cache_key, qvec, history_block, response):
+    _response_cache.put(cache_key, response)
+    if not history_block:  # semantic reuse only when the answer doesn't hinge on earlier turns
+        _semantic_cache.add(qvec, response)
+
+def _stream_response(llm, prompt, on_complete=None):
+    # Yield text deltas as they arrive; surface LLM errors in-band like the blocking path does
+    parts = []
+    try:
+        for chunk in llm.stream(prompt):
+            parts.append(chunk.content)
+            yield chunk.content
+    except Exception as e:
+        yield f"Error contacting LLM: {e}"
+        return
+    if on_complete is not None:
+        on_complete("".join(parts))
+
+def chat_with_agent(query, history=None, index=None, stream=False, limiter=None):
+    """Answer `query` from retrieved context and the relevant slice of `history`.
 
-    # Retrieve relevant documents from the index based on the user's query
-    retrieved_docs = retriever.get_relevant_documents(query)
-    print(f"[DEBUG] Retrieved {len(retrieved_docs)} relevant documents for query")  # Debug: Retrieval count
+    `history` is a sequence (list or deque) of (speaker, message) tuples, oldest first,
+    excluding `query`.
+
+    Returns the full response string, or with stream=True a generator of text chunks
+    (retrieval still happens eagerly; only the LLM completion is streamed).
+    """
+    # Normalize once; every cache key, embedding and retrieval below shares this string
+    normalized = _normalize_query(query or "")
+
+    # Nothing to answer: skip index load, embedding, retrieval and the LLM entirely
+    if not normalized:
+        return iter([EMPTY_QUERY_RESPONSE]) if stream else EMPTY_QUERY_RESPONSE
+
+    # Prefer an index injected by the caller (e.g. app.get_index); else use the process-wide one
+    if index is None:
+        index = _get_index()
+
+    qvec = _query_vector(index, normalized)
+    turns = _select_history(history, qvec, index)
+    history_block = _build_history_block(turns)
+
+    # Repeat / near-repeat questions are answered from cache: no retrieval, no LLM tokens. Answers
+    # that used history are only reused for the same question with the same selected turns, so
+    # mid-conversation hits need HISTORY_MIN_SIMILARITY to drop unrelated turns.
+    cache_key = (normalized, history_block)
+    cached = _response_cache.get(cache_key)
+    if cached is None and not history_block:
+        cached = _semantic_cache.lookup(qvec)
+    if cached is not None:
+        logger.debug("Answering from response cache")
+        return iter([cached]) if stream else cached
+
+    # Retrieve a diverse top-k (MMR over FETCH_K candidates) to keep the prompt small and non-redundant
+    retrieved_docs = _retrieve(index, normalized)
+    logger.debug("Retrieved %d relevant documents for query", len(retrieved_docs))
 
     # Concatenate the content of retrieved documents to form the context for the prompt
-    context = "\n\n".join(doc.page_content for doc in retrieved_docs)
-    print(f"[DEBUG] Context for prompt (first 500 chars):\n{context[:500]}")  # Debug: Context preview
+    context = _build_context(retrieved_docs)
+
+    # Trim history by tokens so one long earlier message can't push the prompt past the model window
+    prompt_history = history_block
+    if turns:
+        base_prompt = DECISION_PROMPT_TEMPLATE.format(context=context, history="", question=query)
+        budget = MODEL_CONTEXT_TOKENS - RESPONSE_TOKEN_RESERVE - _count_tokens(base_prompt)
+        kept = _fit_history(turns, budget)
+        if len(kept) != len(turns):
+            prompt_history = _build_history_block(kept)
+
+    # Format the prompt by injecting the context, relevant history and the user's question
+    prompt = DECISION_PROMPT_TEMPLATE.format(context=context, history=prompt_history, question=query)
+    if logger.isEnabledFor(logging.DEBUG):
+        # Previews slice large strings, so only build them when they will be emitted
+        logger.debug("Context for prompt (first 500 chars):\n%s", context[:500])
+        logger.debug("Prompt for LLM (first 500 chars):\n%s", prompt[:500])
+
+    # Throttle only the LLM call itself, so retrieval above never queues behind the limiter
+    limiter = limiter or _llm_limiter
+    if limiter is not None:
+        limiter.acquire()  # only sleeps when calls arrive faster than MIN_LLM_INTERVAL
+    llm = _get_llm()
 
-    # Format the prompt by injecting the context and the user's question
-    prompt = DECISION_PROMPT_TEMPLATE.format(context=context, question=query)
-    print(f"[DEBUG] Prompt for LLM (first 500 chars):\n{prompt[:500]}")  # Debug: Prompt preview
+    if stream:
+        return _stream_response(
+            llm, prompt, on_complete=lambda text: _remember(cache_key, qvec, history_block, text)
+        )
 
     # Query the LLM with the full prompt and get the response
     try:
-        response = llm.call_as_llm(prompt)
+        response = llm.invoke(prompt).content
+        _remember(cache_key, qvec, history_block, response)
     except Exception as e:
-        response = f"Error contacting LLM: {e}"
-    print(f"[DEBUG] LLM response:\n{response}")  # Debug: LLM output
+        response = f"Error contacting LLM: {e}"  # errors are never cached
+    logger.debug("LLM response:\n%s", response)
 
     # Return the model's response (should include Answer, Decision, Explanation)
     return response
\ No newline at end of file
@@ -1,116 +1,331 @@
 import os
 import os
+import glob
+import json
+import pickle
 import hashlib
+import logging
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from langchain.document_loaders import PyMuPDFLoader, UnstructuredWordDocumentLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 import re
 
+logger = logging.getLogger(__name__)
+
+try:  # optional: SIMD xxh3 for dedupe keys
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:  # optional: Rust xlsx reader, used by pandas as engine="calamine"
+    import python_calamine
+except ImportError:
+    python_calamine = None
+
 # Size-reduction configuration (can be overridden via env vars)
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1500))            # Larger chunks = fewer vectors
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 50))        # Smaller overlap reduces duplication
 MIN_CHUNK_CHARS = int(os.getenv("MIN_CHUNK_CHARS", 80))    # Drop trivial / boilerplate chunks
+POLICY_PARSE_WORKERS = int(os.getenv("POLICY_PARSE_WORKERS", os.cpu_count() or 1))  # parser processes
+
+# Compiled once at import; these run per chunk / per transcript during ingestion
+_WHITESPACE_RE = re.compile(r"\s+")
+_HTML_TAG_RE = re.compile(r"<.*?>")
+_TRANSCRIPT_LINE_RE = re.compile(r"^\d{2}:\d{2}:\d{2} - (?P<sender>.*?) - (?P<message>.*)", re.MULTILINE)
 
 def _normalize(text: str) -> str:
-    return re.sub(r"\s+", " ", text.strip().lower())
+    return _WHITESPACE_RE.sub(" ", text.strip().lower())
 
 def _hash(text: str) -> str:
+    # Stable across processes: used for on-disk cache keys
     return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
+def _dedupe_key(text: str) -> int:
+    # Only compared within one call, so a fast 64-bit non-cryptographic digest is enough;
+    # builtin hash() (per-process salted SipHash) is the fallback when xxhash isn't installed
+    return xxhash.xxh3_64_intdigest(text) if xxhash is not None else hash(text)
+
 def dedupe_documents(documents):
     """Remove exact duplicate (normalized) page_content documents to cut index size."""
     seen = set()
     unique = []
     for d in documents:
-        norm = _normalize(d.page_content)
-        h = _hash(norm)
+        h = _dedupe_key(_normalize(d.page_content))
         if h in seen:
             continue
         seen.add(h)
         unique.append(d)
     return unique
 
+# Built once: the splitter is stateless, so every chunk_text call can share it
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=["\n\n", "\n", ".", " "]
+)
+
 def chunk_text(text, source=""):
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n\n", "\n", ".", " "]
-    )
-    chunks = []
-    for chunk in splitter.split_text(text):
+    """Yield a Document per split of `text`, skipping fragments shorter than MIN_CHUNK_CHARS."""
+    for chunk in _SPLITTER.split_text(text):
         if len(chunk) < MIN_CHUNK_CHARS:
             continue  # skip very small fragments
-        chunks.append(Document(page_content=chunk, metadata={"source": source}))
-    return chunks
+        yield Document(page_content=chunk, metadata={"source": source})
+
+# Excel column -> chunk metadata key
+CHAT_METADATA_COLUMNS = {
+    "EXPERIENCE": "experience",
+    "INITIAL ROUTING GROUP": "initial_group",
+    "FINAL ROUTING GROUP": "final_group",
+    "OUTCOME": "outcome",
+}
+
+def _format_transcript(transcript):
+    # One findall over the whole transcript instead of a regex call per line
+    messages = []
+    for sender, message in _TRANSCRIPT_LINE_RE.findall(transcript):
+        sender = sender.strip()
+        if sender:
+            messages.append(f"{sender}: {message.strip()}")
+    return "\n".join(messages)
+
+def _memoize_on(fingerprint):
+    """Memoize a one-path loader in-process, recomputing only when `fingerprint(path)` changes."""
+    def decorator(loader):
+        memo = {}  # path -> (fingerprint, docs)
 
+        @functools.wraps(loader)
+        def wrapper(path):
+            fp = fingerprint(path)
+            hit = memo.get(path)
+            if hit is None or hit[0] != fp:
+                hit = memo[path] = (fp, loader(path))
+            return list(hit[1])  # shallow copy so callers can't mutate the memo
+
+        wrapper.cache_clear = memo.clear
+        return wrapper
+    return decorator
+
+def _file_fingerprint(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def _folder_fingerprint(folder):
+    return tuple((path, *_file_fingerprint(path)) for path, _ in iter_policy_files(folder))
+
+def _read_excel(path):
+    # calamine parses xlsx several times faster than openpyxl; needs pandas >= 2.2
+    if python_calamine is not None:
+        try:
+            return pd.read_excel(path, engine="calamine")
+        except ValueError as e:
+            logger.debug("calamine engine unavailable (%s); using pandas default", e)
+    return pd.read_excel(path)
+
+def _read_chat_frame(chat_excel_path):
+    """Read the chat workbook, preferring a Parquet copy that is at least as new as the xlsx."""
+    parquet_path = os.path.splitext(chat_excel_path)[0] + ".parquet"
+    try:
+        if os.path.getmtime(parquet_path) >= os.path.getmtime(chat_excel_path):
+            return pd.read_parquet(parquet_path)
+    except OSError:
+        pass  # no Parquet copy yet
+    except Exception as e:
+        logger.warning("Could not read %s (%s); falling back to Excel.", parquet_path, e)
+    df = _read_excel(chat_excel_path)
+    try:
+        df.to_parquet(parquet_path)
+    except Exception as e:
+        logger.warning("Could not write Parquet cache %s: %s", parquet_path, e)
+    return df
+
+def _chat_docs_cache_path(chat_excel_path):
+    # Parsed Documents depend on the source file and the chunking settings
+    mtime_ns = os.stat(chat_excel_path).st_mtime_ns
+    cache_dir = os.path.join(os.path.dirname(chat_excel_path), ".cache")
+    name = f"chat_docs_{mtime_ns}_{CHUNK_SIZE}_{CHUNK_OVERLAP}_{MIN_CHUNK_CHARS}.pkl"
+    return os.path.join(cache_dir, name)
+
+def _load_cached_docs(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring unreadable cache %s: %s", cache_path, e)
+        return None
+
+def _save_cached_docs(cache_path, docs):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(docs, f, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning("Could not write cache %s: %s", cache_path, e)
+
+@_memoize_on(_file_fingerprint)
 def load_chat_data(chat_excel_path):
-    df = pd.read_excel(chat_excel_path)
-    print(f"[DEBUG] Loaded chat Excel file: {chat_excel_path} with {len(df)} rows")
+    cache_path = _chat_docs_cache_path(chat_excel_path)
+    cached = _load_cached_docs(cache_path)
+    if cached is not None:
+        logger.debug("Returning %d cached chat Document objects from: %s", len(cached), cache_path)
+        return cached
+
+    df = _read_chat_frame(chat_excel_path)
+    logger.debug("Loaded chat Excel file: %s with %d rows", chat_excel_path, len(df))
     all_docs = []
+    if 'TRANSCRIPT' not in df.columns:
+        return all_docs
 
-    for _, row in df.iterrows():
-        transcript = row.get('TRANSCRIPT', '')
-        if pd.isna(transcript):
-            continue
+    # Strip markup in one vectorized pass, then pull all (sender, message) pairs per transcript
+    transcripts = df['TRANSCRIPT'].dropna().astype(str).str.replace(_HTML_TAG_RE, '', regex=True).str.strip()
+    chat_texts = transcripts.map(_format_transcript)
+
+    metadata_rows = (
+        df.reindex(columns=list(CHAT_METADATA_COLUMNS), fill_value="")
+        .loc[transcripts.index]
+        .rename(columns=CHAT_METADATA_COLUMNS)
+        .to_dict("records")
+    )
 
-        transcript_clean = re.sub(r'<.*?>', '', str(transcript))
-        lines = transcript_clean.strip().split('\n')
-        messages = []
-
-        for line in lines:
-            match = re.match(r'\d{2}:\d{2}:\d{2} - (.*?) - (.*)', line)
-            if match:
-                sender, message = match.groups()
-                if sender.strip():
-                    messages.append(f"{sender.strip()}: {message.strip()}")
-
-        chat_text = "\n".join(messages)
-        metadata = {
-            "experience": row.get("EXPERIENCE", ""),
-            "initial_group": row.get("INITIAL ROUTING GROUP", ""),
-            "final_group": row.get("FINAL ROUTING GROUP", ""),
-            "outcome": row.get("OUTCOME", "")
-        }
-
-        # Chunk and attach minimal metadata (avoid storing large redundant keys)
-        chunks = chunk_text(chat_text, source="chat")
-        for chunk in chunks:
-            # Only keep small essential metadata keys
-            for k, v in metadata.items():
-                if v:  # don't store empty strings
-                    chunk.metadata[k] = v
+    for chat_text, metadata in zip(chat_texts, metadata_rows):
+        # Only keep small essential metadata keys; don't store empty strings
+        metadata = {k: v for k, v in metadata.items() if v}
+        for chunk in chunk_text(chat_text, source="chat"):
+            chunk.metadata.update(metadata)
             all_docs.append(chunk)
 
     # Deduplicate after chunking to remove overlapping / repeated content
     before = len(all_docs)
     all_docs = dedupe_documents(all_docs)
     after = len(all_docs)
-    print(f"[DEBUG] Returning {after} (was {before}) deduped chat Document objects from file: {chat_excel_path}")
+    logger.info("Loaded %d (was %d) deduped chat Document objects from file: %s", after, before, chat_excel_path)
+    # Drop caches for older versions of the workbook / other chunk settings
+    for stale in glob.glob(os.path.join(os.path.dirname(cache_path), "chat_docs_*.pkl")):
+        if stale != cache_path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+    _save_cached_docs(cache_path, all_docs)
     return all_docs
 
-def load_policy_docs(policy_folder):
-    documents = []
-    print(f"[DEBUG] Scanning policy folder: {policy_folder}")
-    for root, _, files in os.walk(policy_folder):
+SUPPORTED_POLICY_EXTENSIONS = (".pdf", ".docx")
+
+def iter_policy_files(policy_folder):
+    """Yield (path, filename) for each supported policy file, skipping hidden files and dirs."""
+    for root, dirs, files in os.walk(policy_folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]  # skip our own .cache dir
         for file in files:
+            if file.startswith("."):
+                continue
             path = os.path.join(root, file)
-            if file.endswith(".pdf"):
-                loader = PyMuPDFLoader(path)
-                print(f"[DEBUG] Loading PDF: {path}")
-            elif file.endswith(".docx"):
-                loader = UnstructuredWordDocumentLoader(path)
-                print(f"[DEBUG] Loading DOCX: {path}")
-            else:
-                print(f"[DEBUG] Skipping unsupported file: {path}")
+            if not file.endswith(SUPPORTED_POLICY_EXTENSIONS):
+                logger.debug("Skipping unsupported file: %s", path)
                 continue
-            docs = loader.load()
-            text = "\n".join([doc.page_content for doc in docs])
-            # Basic boilerplate filter (drop very short whole-doc extracts)
-            chunks = chunk_text(text, source=file)
-            documents.extend(chunks)
+            yield path, file
+
+POLICY_MANIFEST_NAME = ".manifest.json"   # path -> (mtime, size, cache key, chunk count)
+POLICY_CACHE_DIR_NAME = ".cache"          # per-file pickled chunk lists
+
+def _policy_cache_key(path, stat):
+    # Any change to the file or to the chunking settings yields a new key
+    raw = f"{path}|{stat.st_mtime_ns}|{stat.st_size}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{MIN_CHUNK_CHARS}"
+    return _hash(raw)
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Ignoring unreadable manifest %s: %s", manifest_path, e)
+        return {}
+
+def _write_manifest(manifest_path, manifest):
+    try:
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    except Exception as e:
+        logger.warning("Could not write manifest %s: %s", manifest_path, e)
+
+def _parse_policy_file(path, file):
+    # Module-level so ProcessPoolExecutor can pickle it
+    loader = PyMuPDFLoader(path) if file.endswith(".pdf") else UnstructuredWordDocumentLoader(path)
+    logger.debug("Parsing policy file: %s", path)
+    docs = loader.load()
+    text = "\n".join([doc.page_content for doc in docs])
+    # Basic boilerplate filter (drop very short whole-doc extracts)
+    # Materialised: the result crosses a process boundary and is pickled to the cache
+    return list(chunk_text(text, source=file))
+
+@_memoize_on(_folder_fingerprint)
+def load_policy_docs(policy_folder):
+    """Load + chunk policy files, re-parsing only those whose mtime/size changed since last run."""
+    manifest_path = os.path.join(policy_folder, POLICY_MANIFEST_NAME)
+    cache_dir = os.path.join(policy_folder, POLICY_CACHE_DIR_NAME)
+    manifest = _read_manifest(manifest_path)
+    new_manifest = {}
+    chunks_per_file = []   # in walk order; None until parsed
+    pending = []           # (position, path, file, cache_path, size) needing a fresh parse
+    for path, file in iter_policy_files(policy_folder):
+        stat = os.stat(path)
+        key = _policy_cache_key(path, stat)
+        cache_path = os.path.join(cache_dir, f"{key}.pkl")
+        chunks = None
+        if manifest.get(path, {}).get("cache") == key:
+            chunks = _load_cached_docs(cache_path)
+        if chunks is None:
+            pending.append((len(chunks_per_file), path, file, cache_path, stat.st_size))
+        new_manifest[path] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "cache": key}
+        chunks_per_file.append(chunks)
+
+    # Parsing is CPU-bound: fan new/changed files out across processes
+    if pending:
+        workers = max(1, min(POLICY_PARSE_WORKERS, len(pending)))
+        # Largest files first so one big PDF doesn't start last and become the tail
+        pending.sort(key=lambda item: item[4], reverse=True)
+        paths = [item[1] for item in pending]
+        files = [item[2] for item in pending]
+        if workers == 1:
+            parsed = map(_parse_policy_file, paths, files)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                parsed = list(ex.map(_parse_policy_file, paths, files))
+        for (pos, _, _, cache_path, _), chunks in zip(pending, parsed):
+            _save_cached_docs(cache_path, chunks)
+            chunks_per_file[pos] = chunks
+
+    documents = []
+    for entry, chunks in zip(new_manifest.values(), chunks_per_file):
+        entry["chunks"] = len(chunks)
+        documents.extend(chunks)
+
+    # Forget cache entries for files that were removed or changed
+    live_keys = {entry["cache"] for entry in new_manifest.values()}
+    for entry in manifest.values():
+        if entry.get("cache") not in live_keys:
+            try:
+                os.remove(os.path.join(cache_dir, f"{entry.get('cache')}.pkl"))
+            except OSError:
+                pass
+    if new_manifest != manifest:
+        _write_manifest(manifest_path, new_manifest)
+
     before = len(documents)
     documents = dedupe_documents(documents)
     after = len(documents)
-    print(f"[DEBUG] Returning {after} (was {before}) policy Document objects from folder: {policy_folder}")
+    # One summary line per folder instead of one per file
+    logger.info(
+        "Loaded %d (was %d) policy Document objects from %s (%d of %d files re-parsed)",
+        after, before, policy_folder, len(pending), len(new_manifest),
+    )
     return documents
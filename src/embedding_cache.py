@@ -0,0 +1,64 @@
+import os
+import hashlib
+import sqlite3
+import contextlib
+import numpy as np
+
+# On-disk cache of chunk embeddings keyed by (sha256(text), embedding model)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "data/embed_cache.sqlite")
+_SELECT_BATCH = 500  # stay well under SQLite's bound-parameter limit
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+@contextlib.contextmanager
+def _connect():
+    conn = sqlite3.connect(EMBED_CACHE_PATH)
+    try:
+        with conn:  # commit on success, rollback on error
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "hash TEXT NOT NULL, model TEXT NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL, "
+                "PRIMARY KEY (hash, model))"
+            )
+            yield conn
+    finally:
+        conn.close()
+
+def lookup(hashes, model):
+    """Return {hash: float32 vector} for every hash already embedded with `model`."""
+    found = {}
+    unique = list(dict.fromkeys(hashes))
+    if not unique:
+        return found
+    with _connect() as conn:
+        for start in range(0, len(unique), _SELECT_BATCH):
+            batch = unique[start:start + _SELECT_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT hash, dim, vec FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                [model, *batch],
+            )
+            for h, dim, blob in rows:
+                vec = np.frombuffer(blob, dtype=np.float32)
+                if vec.shape[0] == dim:
+                    found[h] = vec
+    return found
+
+def write(hash, model, vec):
+    write_many([(hash, vec)], model)
+
+def write_many(items, model):
+    """UPSERT an iterable of (hash, vector) pairs in a single transaction."""
+    rows = []
+    for h, vec in items:
+        arr = np.asarray(vec, dtype=np.float32)
+        rows.append((h, model, int(arr.shape[0]), arr.tobytes()))
+    if not rows:
+        return
+    with _connect() as conn:
+        conn.executemany(
+            "INSERT INTO embeddings (hash, model, dim, vec) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(hash, model) DO UPDATE SET dim = excluded.dim, vec = excluded.vec",
+            rows,
+        )
@@ -1,73 +1,125 @@
-# import os
-# from dotenv import load_dotenv
-# from langchain.vectorstores import FAISS
-# from langchain.embeddings import OpenAIEmbeddings
-# from langchain.schema import Document
-
-# _vectorstore = None
-# VECTOR_DB_PATH = "vector_db"
-
-# load_dotenv()  # load environment variables from .env file
-# OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-# def build_or_load_index(chat_data_chunks, policy_docs):
-#     global _vectorstore
-
-#     # If the vectorstore is already loaded in memory, return it
-#     if _vectorstore is not None:
-#         print("[DEBUG] Returning in-memory vectorstore")  # Debug: Using cached vectorstore
-#         return _vectorstore
-
-#     # If the FAISS index exists on disk, load it
-#     if os.path.exists(VECTOR_DB_PATH):
-#         print(f"[DEBUG] Loading FAISS vectorstore from {VECTOR_DB_PATH}")  # Debug: Loading from disk
-#         embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-#         _vectorstore = FAISS.load_local(
-#             VECTOR_DB_PATH, 
-#             embeddings, 
-#             allow_dangerous_deserialization=True  # <-- Add this flag
-#         )
-#         print("[DEBUG] FAISS vectorstore loaded from disk")  # Debug: Loaded from disk
-#         return _vectorstore
-
-#     # If not, create new Documents from chat chunks (if not already Documents)
-#     # If chat_data_chunks are already Document objects, skip this wrapping!
-#     if isinstance(chat_data_chunks[0], Document):
-#         chat_docs = chat_data_chunks
-#         print("[DEBUG] chat_data_chunks are already Document objects")  # Debug: No wrapping needed
-#     else:
-#         chat_docs = [Document(page_content=chunk) for chunk in chat_data_chunks]
-#         print(f"[DEBUG] Wrapped {len(chat_docs)} chat chunks into Document objects")  # Debug: Wrapping
-
-#     # Combine chat and policy docs
-#     all_docs = chat_docs + policy_docs
-#     print(f"[DEBUG] Total documents for indexing: {len(all_docs)}")  # Debug: Total docs
-
-#     # Create embeddings and FAISS index
-#     embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-#     print("[DEBUG] OpenAIEmbeddings initialized")  # Debug: Embeddings status
-#     _vectorstore = FAISS.from_documents(all_docs, embeddings)
-#     print("[DEBUG] FAISS vectorstore created from documents")  # Debug: Vectorstore creation
-
-#     # Save the FAISS index locally for future use
-#     _vectorstore.save_local(VECTOR_DB_PATH)
-#     print(f"[DEBUG] FAISS vectorstore saved to {VECTOR_DB_PATH}")  # Debug: Save status
-
-#     return _vectorstore
-
 import os
+import time
+import logging
+import math
+import uuid
+import random
+import pickle
+import functools
+import shutil
+import hashlib
+import json
+import tempfile
+import itertools
+import threading
+import contextlib
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
 from dotenv import load_dotenv
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_openai import OpenAIEmbeddings
+from openai import OpenAI
 from langchain.schema import Document
+from src import embedding_cache
+from src.rate_limiter import per_minute_bucket
+from src.data_loader import (
+    CHUNK_SIZE, CHUNK_OVERLAP, MIN_CHUNK_CHARS,
+    iter_policy_files, load_chat_data, load_policy_docs,
+)
+
+logger = logging.getLogger(__name__)
+
+try:  # POSIX only; without it concurrent workers may each build the same index
+    import fcntl
+except ImportError:
+    fcntl = None
 
 _vectorstore = None
-FAISS_DB_PATH = "vector_db"   # local directory for FAISS index
+_vectorstore_dir = None  # where _vectorstore is persisted, for incremental updates
+FAISS_DB_PATH = "vector_db"   # local directory for FAISS index (when no source signature is given)
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", "data/index_cache")  # one subdir per source signature
+EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+# text-embedding-3 vectors can be shortened (Matryoshka) with little recall loss: 512 dims is 3x less
+# RAM and distance work than the native 1536. 0 = the model's native size
+EMBEDDING_DIMENSIONS = int(os.getenv(
+    "OPENAI_EMBEDDING_DIMENSIONS", 512 if EMBEDDING_MODEL.startswith("text-embedding-3") else 0
+))
+# Key for the embedding cache: vectors of different lengths from one model must not mix
+EMBEDDING_CACHE_MODEL = f"{EMBEDDING_MODEL}@{EMBEDDING_DIMENSIONS}" if EMBEDDING_DIMENSIONS else EMBEDDING_MODEL
+INDEX_META_NAME = "meta.json"  # {model, dimensions, metric} the persisted index was built with
+CONTENT_HASH_NAME = "content.hash"  # digest of the chunks + settings the persisted index was built from
+# Texts per embeddings request; 512 chunks of CHUNK_SIZE chars stays well under the API's
+# 2048-input / ~300k-token per-request caps
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", 512))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 4))     # batches in flight at once
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", 3))  # per batch, with exponential backoff
+EMBED_SUBMIT_JITTER = float(os.getenv("EMBED_SUBMIT_JITTER", 0.2))  # max random delay (s) before a batch's first request
+
+# Opt-in OpenAI Batch API for large first-time builds: half the price and outside the RPM/TPM
+# limits, but asynchronous (up to 24h), so only used when at least BATCH_API_MIN_TEXTS need embedding
+USE_BATCH_API = os.getenv("USE_BATCH_API", "0") == "1"
+BATCH_API_MIN_TEXTS = int(os.getenv("BATCH_API_MIN_TEXTS", 10000))
+BATCH_API_POLL_SECONDS = float(os.getenv("BATCH_API_POLL_SECONDS", 30))
+BATCH_API_MAX_INPUTS = int(os.getenv("BATCH_API_MAX_INPUTS", 50000))  # OpenAI's per-job cap for embeddings
+# Give up on unfinished jobs after this many seconds (the build lock is held meanwhile) and embed
+# their texts directly
+BATCH_API_MAX_WAIT = float(os.getenv("BATCH_API_MAX_WAIT", 2 * 3600))
+_BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+# Org rate limits for the embeddings endpoint (0 = don't throttle client-side)
+EMBED_MAX_REQUESTS_PER_MINUTE = int(os.getenv("EMBED_MAX_REQUESTS_PER_MINUTE", 0))
+EMBED_MAX_TOKENS_PER_MINUTE = int(os.getenv("EMBED_MAX_TOKENS_PER_MINUTE", 0))
+
+# HNSW graph parameters (sub-linear search instead of a flat linear scan)
+HNSW_M = int(os.getenv("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64))
+
+# Map the persisted index read-only instead of copying it onto the heap; the page cache is then
+# shared by every worker process that loads the same file
+USE_MMAP = os.getenv("USE_MMAP", "0") == "1"
+
+# Vector storage: "hnsw_sq8" keeps int8 codes (4x smaller than float32), "hnsw" keeps raw float32,
+# "ivf_flat" / "ivf_fp16" / "ivf_sq8" keep float32 / float16 / int8 codes in IVF lists (the layout
+# faiss can mmap), "ivf_pq" is IVF{4*sqrt(n)},PQ (FAISS_PQ_M bytes/vector), "factory" builds
+# FAISS_INDEX_FACTORY. "auto" picks ivf_pq from FAISS_IVF_PQ_MIN_VECTORS up, else ivf_sq8 under
+# USE_MMAP, else hnsw_sq8
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+FAISS_IVF_PQ_MIN_VECTORS = int(os.getenv("FAISS_IVF_PQ_MIN_VECTORS", 10000))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", 64))  # PQ sub-quantizers (bytes per vector at 8 bits each)
+FAISS_INDEX_FACTORY = os.getenv("FAISS_INDEX_FACTORY", "OPQ32,IVF4096_HNSW32,PQ64")
+FAISS_TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", 10000))  # vectors used to train SQ codecs
+FAISS_IVF_TRAIN_SAMPLE = int(os.getenv("FAISS_IVF_TRAIN_SAMPLE", 50000))  # IVF/PQ need more to train
+FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", 0))  # lists scanned per query; 0 = max(8, nlist // 32)
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", 256))  # upper bound on lists for the ivf_* codecs below
+
+# OpenMP threads faiss may use for search/training; default leaves half the cores to the web server
+FAISS_OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", max(1, (os.cpu_count() or 2) // 2)))
+
+# IVF index type -> faiss factory codec for the vectors stored in each list
+_IVF_CODECS = {"ivf_flat": "Flat", "ivf_fp16": "SQfp16", "ivf_sq8": "SQ8"}
+
+# Incremental updates go to a small flat delta index beside the trained main one; once the delta
+# exceeds this fraction of the main index, both are folded into a fresh index in the background
+INCREMENTAL_REBUILD_RATIO = float(os.getenv("INCREMENTAL_REBUILD_RATIO", 0.5))
+_update_lock = threading.Lock()  # serialises delta adds / searches and retrain swaps
+_delta_index = None  # IndexFlatIP; row j is docstore position main.ntotal + j
+_retrain_thread = None
+# Saving rewrites the whole index and docstore, so incremental adds are saved in batches of this
+# many documents (and on exit) rather than on every call
+PERSIST_EVERY_ADDS = int(os.getenv("PERSIST_EVERY_ADDS", 500))
+_persist_lock = threading.Lock()  # one save at a time, so a newer snapshot always lands last
+_unsaved_adds = 0
 
 load_dotenv()
 
+@functools.lru_cache(maxsize=1)
 def _get_api_key():
-    # Re-read each time so late injection (e.g. Streamlit secrets) works
+    # Cached once found; a missing key raises (and isn't cached), so late injection via Streamlit
+    # secrets still works on the next call
     key = os.getenv("OPENAI_API_KEY")
     if not key:
         # Try Streamlit secrets directly (works even if this module imported before app sets env)
@@ -84,49 +136,711 @@ def _get_api_key():
         )
     return key
 
-def build_or_load_index(chat_data_chunks, policy_docs):
+@functools.lru_cache(maxsize=1)
+def _get_embeddings():
+    # One client (HTTP pool, tokenizer) per process; a missing key raises and is not cached
+    # chunk_size matches EMBED_BATCH so each of our batches goes out as exactly one HTTP request
+    kwargs = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+    return OpenAIEmbeddings(openai_api_key=_get_api_key(), model=EMBEDDING_MODEL, chunk_size=EMBED_BATCH, **kwargs)
+
+def _index_meta():
+    return {"model": EMBEDDING_MODEL, "dimensions": EMBEDDING_DIMENSIONS, "metric": "inner_product"}
+
+# Vectors are unit-normalised before insertion, so inner product == cosine similarity. (Query norm
+# doesn't change an inner-product ranking, so the wrapper needs no normalize_L2, which LangChain
+# warns about for this strategy.)
+_STORE_KWARGS = {"distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT}
+
+def source_signature(chat_excel_path, policy_folder):
+    """Fingerprint of every input file (path, mtime, size) plus the settings that shape the index."""
+    entries = []
+    for path in [chat_excel_path] + [path for path, _ in iter_policy_files(policy_folder)]:
+        stat = os.stat(path)
+        entries.append(f"{path}|{stat.st_mtime_ns}|{stat.st_size}")
+    entries.sort()
+    entries.append(_index_settings())
+    return hashlib.sha256("\n".join(entries).encode("utf-8")).hexdigest()
+
+def _index_settings():
+    return (
+        f"{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{MIN_CHUNK_CHARS}|"
+        f"{FAISS_INDEX_TYPE}|{FAISS_INDEX_FACTORY}|{FAISS_IVF_NLIST}|{FAISS_IVF_PQ_MIN_VECTORS}|{FAISS_PQ_M}|"
+        f"{USE_MMAP}|{HNSW_M}|{HNSW_EF_CONSTRUCTION}|ip"
+    )
+
+def content_fingerprint(texts, metadatas):
+    """Order-independent digest of the chunks (text + metadata) and the settings that shape the index."""
+    rows = sorted(
+        text.encode("utf-8") + b"\x01" + json.dumps(meta, sort_keys=True, default=str).encode("utf-8")
+        for text, meta in zip(texts, metadatas)
+    )
+    digest = hashlib.blake2b(_index_settings().encode("utf-8"), digest_size=16)
+    for row in rows:
+        digest.update(b"\x00" + row)
+    return digest.hexdigest()
+
+def _find_by_content(content_hash):
+    """A persisted index directory built from exactly this content, or None."""
+    candidates = []
+    try:
+        with os.scandir(INDEX_CACHE_DIR) as entries:
+            candidates += [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith(".")]
+    except FileNotFoundError:
+        pass
+    candidates.append(FAISS_DB_PATH)  # last: a cache entry can be adopted by rename, this one is copied
+    for path in candidates:
+        try:
+            with open(os.path.join(path, CONTENT_HASH_NAME), encoding="utf-8") as f:
+                if f.read().strip() == content_hash:
+                    return path
+        except OSError:
+            continue
+    return None
+
+def _load_mmapped(path, embeddings):
+    """Same on-disk layout as FAISS.save_local, but the vectors are mmapped rather than read in."""
+    index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        **_STORE_KWARGS,
+    )
+
+def _nonempty_dir(path):
+    # One scandir that stops at the first entry, instead of exists() plus a full listdir()
+    try:
+        with os.scandir(path) as entries:
+            return any(True for _ in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+def _load_persisted(path, embeddings):
+    if not _nonempty_dir(path):
+        return None
+    # Vectors from another model / dimension count can't be searched with today's query embeddings
+    try:
+        with open(os.path.join(path, INDEX_META_NAME), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    expected = _index_meta()
+    if not isinstance(meta, dict) or any(meta.get(k) != v for k, v in expected.items()):
+        logger.warning("FAISS index at %s was built with %s, not %s; rebuilding.", path, meta, expected)
+        return None
+    if USE_MMAP:
+        try:
+            store = _load_mmapped(path, embeddings)
+            _tune_index(store.index)
+            _restore_delta(store)
+            logger.debug("FAISS index memory-mapped from %s", path)
+            return store
+        except Exception as e:
+            logger.warning("Could not mmap FAISS index from %s (%s); loading into memory.", path, e)
+    try:
+        store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True, **_STORE_KWARGS)
+        _tune_index(store.index)
+        _restore_delta(store)
+        logger.debug("FAISS index loaded from %s", path)
+        return store
+    except Exception as e:
+        logger.warning("Failed to load existing FAISS index from %s (%s); rebuilding.", path, e)
+        return None
+
+def _persist_atomically(store, dest, content_hash=None):
+    """Save into a temp dir beside `dest`, then swap it in with os.replace."""
+    parent = os.path.dirname(os.path.abspath(dest))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+    try:
+        store.save_local(tmp)
+        with open(os.path.join(tmp, INDEX_META_NAME), "w", encoding="utf-8") as f:
+            json.dump(_index_meta(), f)
+        if content_hash:
+            with open(os.path.join(tmp, CONTENT_HASH_NAME), "w", encoding="utf-8") as f:
+                f.write(content_hash)
+        if os.path.exists(dest):
+            # Directories can't be replaced while non-empty: move the old one aside first
+            old = tempfile.mkdtemp(prefix=".old-", dir=parent)
+            os.replace(dest, os.path.join(old, "index"))
+            os.replace(tmp, dest)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.replace(tmp, dest)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+@contextlib.contextmanager
+def _build_lock():
+    """Exclusive cross-process lock held while one worker builds the shared on-disk index."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(INDEX_CACHE_DIR, ".build.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+        yield
+
+def _prune_index_cache(keep):
+    # Indexes for superseded source signatures are never read again
+    try:
+        with os.scandir(INDEX_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name != keep:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+    except FileNotFoundError:
+        pass
+
+def _embed_one_batch(batch, embeddings, request_bucket, token_bucket):
+    # Spread out the first wave so EMBED_WORKERS requests don't hit the API in the same instant
+    if EMBED_SUBMIT_JITTER > 0:
+        time.sleep(random.uniform(0, EMBED_SUBMIT_JITTER))
+    for attempt in range(1, EMBED_MAX_ATTEMPTS + 1):
+        if request_bucket is not None:
+            request_bucket.acquire()
+        if token_bucket is not None:
+            token_bucket.acquire(sum(len(t) for t in batch) // 4 + len(batch))  # ~4 chars per token
+        try:
+            return embeddings.embed_documents(batch)
+        except Exception as e:
+            if attempt == EMBED_MAX_ATTEMPTS:
+                raise
+            delay = 2 ** (attempt - 1) + random.uniform(0, 1)
+            logger.warning(
+                "Embedding batch failed (%s); retry %d/%d in %.1fs", e, attempt, EMBED_MAX_ATTEMPTS - 1, delay
+            )
+            time.sleep(delay)
+
+def _embed_batched(texts, embeddings):
+    """Embed `texts` in EMBED_BATCH-sized requests, overlapping up to EMBED_WORKERS at a time."""
+    batches = [texts[i:i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+    # Shared by all workers so the limits hold for the build as a whole
+    request_bucket = per_minute_bucket(EMBED_MAX_REQUESTS_PER_MINUTE)
+    token_bucket = per_minute_bucket(EMBED_MAX_TOKENS_PER_MINUTE)
+    vectors = None
+    # Network-bound: threads overlap the HTTPS round-trips; map() preserves batch order
+    with ThreadPoolExecutor(max_workers=max(1, EMBED_WORKERS)) as ex:
+        results = ex.map(lambda batch: _embed_one_batch(batch, embeddings, request_bucket, token_bucket), batches)
+        for b, batch_vecs in enumerate(results):
+            batch_vecs = np.asarray(batch_vecs, dtype=np.float32)
+            if vectors is None:
+                vectors = np.empty((len(texts), batch_vecs.shape[1]), dtype=np.float32)
+            start = b * EMBED_BATCH
+            vectors[start:start + len(batch_vecs)] = batch_vecs
+    logger.debug("Embedded %d texts in %d batches", len(texts), len(batches))
+    return vectors
+
+def _submit_batch_job(client, body, batches, first, stop):
+    """Upload requests for batches[first:stop] and start a job; returns (input file id, job)."""
+    fd, request_path = tempfile.mkstemp(suffix=".jsonl")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for b in range(first, stop):
+                f.write(json.dumps({
+                    "custom_id": str(b),
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {**body, "input": batches[b]},
+                }) + "\n")
+        with open(request_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+    finally:
+        os.remove(request_path)
+    job = client.batches.create(input_file_id=input_file.id, endpoint="/v1/embeddings", completion_window="24h")
+    logger.info("Submitted embedding batch job %s (requests %d-%d of %d)", job.id, first, stop - 1, len(batches))
+    return input_file.id, job
+
+def _embed_via_batch_api(texts, embeddings):
+    """Embed `texts` through the OpenAI Batch API, blocking until the jobs finish or BATCH_API_MAX_WAIT.
+
+    Requests the jobs did not return successfully are re-embedded with _embed_batched.
+    """
+    client = OpenAI(api_key=_get_api_key())
+    batches = [texts[i:i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+    body = {"model": EMBEDDING_MODEL}
+    if EMBEDDING_DIMENSIONS:
+        body["dimensions"] = EMBEDDING_DIMENSIONS
+    # One job per BATCH_API_MAX_INPUTS texts; a larger job would fail validation outright
+    per_job = max(1, BATCH_API_MAX_INPUTS // EMBED_BATCH)
+    file_ids, jobs, finished, done = [], [], [], {}
+    try:
+        for first in range(0, len(batches), per_job):
+            input_file_id, job = _submit_batch_job(client, body, batches, first, min(first + per_job, len(batches)))
+            file_ids.append(input_file_id)
+            jobs.append(job)
+
+        deadline = time.monotonic() + BATCH_API_MAX_WAIT
+        while jobs:
+            finished += [job for job in jobs if job.status in _BATCH_DONE]
+            jobs = [job for job in jobs if job.status not in _BATCH_DONE]
+            if jobs and time.monotonic() >= deadline:
+                for job in jobs:
+                    logger.warning("Embedding batch job %s still %s after %.0fs; cancelling",
+                                   job.id, job.status, BATCH_API_MAX_WAIT)
+                    try:
+                        client.batches.cancel(job.id)
+                    except Exception as e:
+                        logger.warning("Could not cancel embedding batch job %s: %s", job.id, e)
+                break
+            if jobs:
+                time.sleep(BATCH_API_POLL_SECONDS)
+                jobs = [client.batches.retrieve(job.id) for job in jobs]
+
+        for job in finished:
+            file_ids += [file_id for file_id in (job.output_file_id, job.error_file_id) if file_id]
+            counts = job.request_counts
+            if job.status != "completed" or (counts and counts.failed):
+                logger.warning("Embedding batch job %s ended with status %s (%s requests failed)",
+                               job.id, job.status, counts.failed if counts else "?")
+            if job.error_file_id:
+                for line in client.files.content(job.error_file_id).text.splitlines()[:5]:
+                    logger.warning("Embedding batch error: %s", line)
+            if not job.output_file_id:
+                continue
+            # Output lines arrive in any order; custom_id is the batch position
+            for line in client.files.content(job.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    continue
+                b = int(result["custom_id"])
+                data = sorted(response["body"]["data"], key=lambda item: item["index"])
+                if len(data) == len(batches[b]):
+                    done[b] = np.asarray([item["embedding"] for item in data], dtype=np.float32)
+    finally:
+        # Uploaded requests and results would otherwise count against the org's file storage
+        for file_id in file_ids:
+            try:
+                client.files.delete(file_id)
+            except Exception as e:
+                logger.debug("Could not delete batch file %s: %s", file_id, e)
+
+    # Anything missing, failed or still running is embedded directly, so no row is left uninitialised
+    missing = [b for b in range(len(batches)) if b not in done]
+    if missing:
+        logger.warning("Re-embedding %d/%d batch requests the jobs did not return", len(missing), len(batches))
+        redo = _embed_batched([t for b in missing for t in batches[b]], embeddings)
+        offset = 0
+        for b in missing:
+            done[b] = redo[offset:offset + len(batches[b])]
+            offset += len(batches[b])
+    return np.vstack([done[b] for b in range(len(batches))])
+
+def _embed_with_cache(texts, embeddings, model):
+    """Embed `texts`, only calling the API for chunks not already in the on-disk cache."""
+    hashes = [embedding_cache.content_hash(t) for t in texts]
+    try:
+        cached = embedding_cache.lookup(hashes, model)
+    except Exception as e:
+        logger.warning("Embedding cache unavailable (%s); embedding everything.", e)
+        cached = {}
+
+    # Keep positions of uncached chunks so fresh vectors slot back in order
+    uncached_indices = [i for i, h in enumerate(hashes) if h not in cached]
+    logger.debug("Embedding cache hits: %d/%d", len(texts) - len(uncached_indices), len(texts))
+
+    fresh = None
+    if uncached_indices:
+        # Identical texts (e.g. boilerplate shared by chat and policy chunks) are embedded once
+        row_of, unique_indices = {}, []
+        for i in uncached_indices:
+            if hashes[i] not in row_of:
+                row_of[hashes[i]] = len(unique_indices)
+                unique_indices.append(i)
+        pending = [texts[i] for i in unique_indices]
+        if USE_BATCH_API and len(pending) >= BATCH_API_MIN_TEXTS:
+            unique_vecs = _embed_via_batch_api(pending, embeddings)
+        else:
+            unique_vecs = _embed_batched(pending, embeddings)
+        try:
+            embedding_cache.write_many(((hashes[i], v) for i, v in zip(unique_indices, unique_vecs)), model)
+        except Exception as e:
+            logger.warning("Could not update embedding cache: %s", e)
+        fresh = unique_vecs[[row_of[hashes[i]] for i in uncached_indices]]
+
+    dim = fresh.shape[1] if fresh is not None else next(iter(cached.values())).shape[0]
+    vectors = np.empty((len(texts), dim), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        if h in cached:
+            vectors[i] = cached[h]
+    if fresh is not None:
+        vectors[uncached_indices] = fresh
+    # Unit length once here, so every index can rank by inner product (== cosine)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def _ivf_of(index):
+    # extract_index_ivf hands back a bare IndexIVF proxy; downcast so subclass fields such as
+    # IndexIVFPQ.use_precomputed_table are visible (and settable)
+    try:
+        return faiss.downcast_index(faiss.extract_index_ivf(index))
+    except RuntimeError:
+        return None
+
+@functools.lru_cache(maxsize=1)
+def _set_omp_threads():
+    # The OpenMP pool is process-wide, so it is only resized once an index is actually loaded or
+    # built here, not as a side effect of importing this module
+    faiss.omp_set_num_threads(FAISS_OMP_THREADS)
+
+def _tune_index(index):
+    # efSearch / nprobe are query-time knobs; apply them to freshly built and loaded indexes alike
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    ivf = _ivf_of(index)
+    if ivf is not None:
+        ivf.nprobe = FAISS_IVF_NPROBE or max(8, ivf.nlist // 32)
+        # MMR reranking reconstructs candidate vectors by id, which IVF only supports via a direct map
+        if ivf.direct_map.no():
+            ivf.make_direct_map()
+    return index
+
+def _training_sample(vectors, size):
+    if len(vectors) <= size:
+        return vectors
+    rows = np.random.default_rng(0).choice(len(vectors), size=size, replace=False)
+    return vectors[np.sort(rows)]
+
+def _new_factory_index(vectors):
+    """IVF/PQ index from FAISS_INDEX_FACTORY, or None if the corpus is too small to train it."""
+    index = faiss.index_factory(vectors.shape[1], FAISS_INDEX_FACTORY, faiss.METRIC_INNER_PRODUCT)
+    ivf = _ivf_of(index)
+    if ivf is not None:
+        if len(vectors) < ivf.nlist:
+            logger.warning("%d vectors can't train %d IVF lists; falling back to HNSW.", len(vectors), ivf.nlist)
+            return None
+        if hasattr(ivf, "use_precomputed_table"):
+            ivf.use_precomputed_table = -1  # skip the nlist x M x 256 residual table to save RAM
+    _tune_index(index)
+    index.train(_training_sample(vectors, FAISS_IVF_TRAIN_SAMPLE))
+    return index
+
+def _new_ivf_pq_index(vectors):
+    """IVF{4*sqrt(n)},PQ{m}x8 sized to the corpus, or None if it is too small to train the codebooks."""
+    n, dim = vectors.shape
+    if n < 256:  # each 8-bit PQ codebook has 256 centroids
+        logger.warning("%d vectors are too few to train PQ; falling back to HNSW.", n)
+        return None
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    m = math.gcd(dim, FAISS_PQ_M)  # sub-quantizers must divide the dimension
+    index = faiss.index_factory(dim, f"IVF{nlist},PQ{m}x8", faiss.METRIC_INNER_PRODUCT)
+    ivf = _ivf_of(index)
+    ivf.use_precomputed_table = -1  # skip the nlist x M x 256 residual table to save RAM
+    _tune_index(index)
+    index.train(_training_sample(vectors, FAISS_IVF_TRAIN_SAMPLE))
+    return index
+
+def _new_faiss_index(vectors, index_type=None):
+    """Create (and train, if the codec needs it) an empty FAISS index of FAISS_INDEX_TYPE."""
+    dim = vectors.shape[1]
+    index_type = index_type or FAISS_INDEX_TYPE
+    if index_type == "auto":
+        if len(vectors) >= FAISS_IVF_PQ_MIN_VECTORS:
+            index_type = "ivf_pq"
+        else:
+            index_type = "ivf_sq8" if USE_MMAP else "hnsw_sq8"
+    if index_type == "ivf_pq":
+        index = _new_ivf_pq_index(vectors)
+        if index is not None:
+            return index
+        index_type = "hnsw_sq8"
+    if index_type == "factory":
+        index = _new_factory_index(vectors)
+        if index is not None:
+            return index
+        index_type = "hnsw_sq8"
+    if index_type in _IVF_CODECS:
+        # ~39 training points per list is faiss' floor; shrink nlist for small corpora
+        nlist = max(1, min(FAISS_IVF_NLIST, len(vectors) // 39))
+        index = faiss.index_factory(dim, f"IVF{nlist},{_IVF_CODECS[index_type]}", faiss.METRIC_INNER_PRODUCT)
+        _tune_index(index)
+        # Trains the coarse centroids and, for SQ codecs, the per-dimension value ranges
+        index.train(_training_sample(vectors, FAISS_IVF_TRAIN_SAMPLE))
+        return index
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw_sq8":
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(
+            f"Unknown FAISS_INDEX_TYPE {index_type!r} (expected 'auto', 'hnsw', 'hnsw_sq8', "
+            f"'ivf_flat', 'ivf_fp16', 'ivf_sq8', 'ivf_pq' or 'factory')"
+        )
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    _tune_index(index)
+    if not index.is_trained:
+        # SQ8 learns per-dimension ranges; a sample is plenty
+        index.train(_training_sample(vectors, FAISS_TRAIN_SAMPLE))
+    return index
+
+def _build_vectorstore(texts, vectors, metadatas, embeddings):
+    """Wrap a FAISS index over precomputed `vectors` in a LangChain FAISS store."""
+    index = _new_faiss_index(vectors)
+    index.add(vectors)
+
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=meta)
+        for doc_id, text, meta in zip(ids, texts, metadatas)
+    })
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(ids)),
+        **_STORE_KWARGS,
+    )
+
+def load_index_for_sources(chat_excel_path, policy_folder):
+    """Return the index for these source files, only reading/parsing them if no persisted index matches."""
     global _vectorstore
+    if _vectorstore is not None:
+        logger.debug("Returning in-memory vectorstore")
+        return _vectorstore
+
+    global _vectorstore_dir
+    _set_omp_threads()
+    signature = source_signature(chat_excel_path, policy_folder)
+    persist_dir = os.path.join(INDEX_CACHE_DIR, signature)
+    store = _load_persisted(persist_dir, _get_embeddings())
+    if store is None:
+        # One worker builds; the others wait here, then load (or mmap) the index it persisted
+        with _build_lock():
+            store = _load_persisted(persist_dir, _get_embeddings())
+            if store is None:
+                return build_or_load_index(
+                    load_chat_data(chat_excel_path), load_policy_docs(policy_folder), signature=signature
+                )
+    _vectorstore = store
+    _vectorstore_dir = persist_dir
+    return _vectorstore
+
+def build_or_load_index(chat_data_chunks, policy_docs, signature=None):
+    global _vectorstore, _vectorstore_dir, _delta_index
 
     # If the vectorstore is already loaded in memory, return it
     if _vectorstore is not None:
-        print("[DEBUG] Returning in-memory vectorstore")
+        logger.debug("Returning in-memory vectorstore")
         return _vectorstore
 
+    _set_omp_threads()
     # Initialize embeddings
-    embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
-    api_key = _get_api_key()
-    embeddings = OpenAIEmbeddings(openai_api_key=api_key, model=embedding_model)
-    print(f"[DEBUG] Using embedding model: {embedding_model}")
-
-    # Attempt Chroma load/create unless FAISS forced
-    # Load FAISS if present
-    if os.path.exists(FAISS_DB_PATH) and os.listdir(FAISS_DB_PATH):
-        try:
-            _vectorstore = FAISS.load_local(FAISS_DB_PATH, embeddings, allow_dangerous_deserialization=True)
-            print(f"[DEBUG] FAISS index loaded from {FAISS_DB_PATH}")
+    embeddings = _get_embeddings()
+    logger.debug("Using embedding model: %s", EMBEDDING_MODEL)
+
+    # Load FAISS if present for this source signature (or the legacy unversioned path)
+    persist_dir = os.path.join(INDEX_CACHE_DIR, signature) if signature else FAISS_DB_PATH
+    _vectorstore_dir = persist_dir
+    store = _load_persisted(persist_dir, embeddings)
+    if store is not None:
+        _vectorstore = store
+        return _vectorstore
+
+    # Nothing persisted and nothing to embed: let the caller decide what to do
+    if not chat_data_chunks and not policy_docs:
+        raise ValueError("No chat or policy documents to index and no persisted FAISS index found.")
+
+    # Parallel texts / metadatas straight from both inputs (chat chunks may be Documents or plain
+    # strings): no combined Document list, and plain strings are never wrapped just to be unwrapped
+    texts, metadatas = [], []
+    for item in itertools.chain(chat_data_chunks, policy_docs):
+        if isinstance(item, Document):
+            texts.append(item.page_content)
+            metadatas.append(item.metadata)
+        else:
+            texts.append(item)
+            metadatas.append({})
+    logger.debug("Total documents for indexing: %d", len(texts))
+
+    # Sources were touched (new mtime) but chunk to exactly the same content: adopt that index
+    content_hash = content_fingerprint(texts, metadatas)
+    match = _find_by_content(content_hash)
+    if match is not None and match != persist_dir:
+        # Only cache entries may be moved; the legacy FAISS_DB_PATH is still read by signature-less
+        # callers, so it is loaded and re-saved below instead
+        in_cache = os.path.dirname(os.path.abspath(match)) == os.path.abspath(INDEX_CACHE_DIR)
+        if in_cache and not os.path.exists(persist_dir):
+            try:
+                os.replace(match, persist_dir)  # a rename; nothing is rewritten
+                match = persist_dir
+            except OSError:
+                pass
+        store = _load_persisted(match, embeddings)
+        if store is not None:
+            logger.info("Source content unchanged; reusing FAISS index from %s", match)
+            _vectorstore = store
+            try:
+                if match != persist_dir:
+                    _persist_atomically(store, persist_dir, content_hash)
+                if signature:
+                    _prune_index_cache(keep=signature)
+            except Exception as e:
+                logger.warning("Could not persist FAISS index: %s", e)
             return _vectorstore
+
+    # Build FAISS from (text, vector) pairs, reusing cached embeddings where possible
+    vectors = _embed_with_cache(texts, embeddings, EMBEDDING_CACHE_MODEL)
+    _vectorstore = _build_vectorstore(texts, vectors, metadatas, embeddings)
+    _delta_index = None
+    logger.debug("FAISS vectorstore created from documents")
+    try:
+        _persist_atomically(_vectorstore, persist_dir, content_hash)
+        logger.info("FAISS index saved to %s", persist_dir)
+        if signature:
+            _prune_index_cache(keep=signature)
+    except Exception as e:
+        logger.warning("Could not persist FAISS index: %s", e)
+
+    return _vectorstore
+
+def _docstore_texts(store, start, stop):
+    return [store.docstore.search(store.index_to_docstore_id[i]).page_content for i in range(start, stop)]
+
+def _persist_current(store):
+    """Save `store` over its persisted copy; call without _update_lock held."""
+    global _unsaved_adds
+    if _vectorstore_dir is None:
+        return
+    with _persist_lock:
+        with _update_lock:
+            # The main index is never mutated once live, so only the dicts add_documents updates in
+            # place need copying before they can be pickled outside the lock. Delta documents are
+            # saved in the docstore past the main index's vectors and re-indexed on load.
+            snapshot = FAISS(
+                embedding_function=store.embedding_function,
+                index=store.index,
+                docstore=InMemoryDocstore(dict(store.docstore._dict)),
+                index_to_docstore_id=dict(store.index_to_docstore_id),
+                **_STORE_KWARGS,
+            )
+            _unsaved_adds = 0
+        try:
+            with _build_lock():
+                _persist_atomically(snapshot, _vectorstore_dir)
         except Exception as e:
-            print(f"[WARN] Failed to load existing FAISS index ({e}); rebuilding.")
+            logger.warning("Could not persist updated FAISS index: %s", e)
 
-    # Wrap chat_data_chunks if needed
-    if isinstance(chat_data_chunks[0], Document):
-        chat_docs = chat_data_chunks
-        print("[DEBUG] chat_data_chunks are already Document objects")
-    else:
-        chat_docs = [Document(page_content=chunk) for chunk in chat_data_chunks]
-        print(f"[DEBUG] Wrapped {len(chat_docs)} chat chunks into Document objects")
+def flush_index():
+    """Save documents added since the last save; registered to run at exit."""
+    if _unsaved_adds and _vectorstore is not None:
+        _persist_current(_vectorstore)
+
+atexit.register(flush_index)
+
+def _restore_delta(store):
+    """Rebuild the delta index for persisted documents that the main index doesn't hold."""
+    global _delta_index, _unsaved_adds
+    base, total = store.index.ntotal, len(store.index_to_docstore_id)
+    _delta_index, _unsaved_adds = None, 0
+    if total > base:
+        vectors = _embed_with_cache(_docstore_texts(store, base, total), store.embedding_function, EMBEDDING_CACHE_MODEL)
+        _delta_index = faiss.IndexFlatIP(vectors.shape[1])
+        _delta_index.add(vectors)
+        logger.debug("Restored %d delta vectors", total - base)
 
-    all_docs = chat_docs + policy_docs
-    print(f"[DEBUG] Total documents for indexing: {len(all_docs)}")
+def search_with_vectors(store, qvec, k):
+    """Top-`k` docstore positions for unit `qvec` over the main and delta indexes, plus their vectors."""
+    q = np.asarray(qvec, dtype=np.float32).reshape(1, -1)
+    with _update_lock:
+        main, delta = store.index, (_delta_index if store is _vectorstore else None)
+    scores, ids = main.search(q, k)
+    scores, ids = scores[0], ids[0]
+    if delta is not None and delta.ntotal:
+        # Flat search over the few vectors added since the last retrain; merged by score
+        with _update_lock:
+            d_scores, d_ids = delta.search(q, min(k, delta.ntotal))
+        scores = np.concatenate([scores, d_scores[0]])
+        ids = np.concatenate([ids, np.where(d_ids[0] >= 0, d_ids[0] + main.ntotal, -1)])
+        order = np.argsort(-scores, kind="stable")[:k]
+        scores, ids = scores[order], ids[order]
+    ids = ids[ids != -1]
+    if not len(ids):
+        return ids, np.empty((0, q.shape[1]), dtype=np.float32)
+    # One C++ call per index for all candidate vectors instead of a Python loop of reconstruct()
+    in_main = ids < main.ntotal
+    vectors = np.empty((len(ids), q.shape[1]), dtype=np.float32)
+    if in_main.any():
+        vectors[in_main] = main.reconstruct_batch(ids[in_main])
+    if not in_main.all():
+        with _update_lock:
+            vectors[~in_main] = delta.reconstruct_batch(ids[~in_main] - main.ntotal)
+    return ids, vectors
 
-    # Build FAISS from documents
-    _vectorstore = FAISS.from_documents(all_docs, embeddings)
-    print("[DEBUG] FAISS vectorstore created from documents")
+def _retrain(store):
+    """Train a fresh index on every document's (cached) embedding and swap it in for main + delta."""
+    global _delta_index
+    count = len(store.index_to_docstore_id)
+    vectors = _embed_with_cache(_docstore_texts(store, 0, count), store.embedding_function, EMBEDDING_CACHE_MODEL)
+    index = _new_faiss_index(vectors)
+    index.add(vectors)
+    with _update_lock:
+        # Documents added while we were training stay in a (smaller) delta
+        total = len(store.index_to_docstore_id)
+        delta = None
+        if total > count:
+            delta = faiss.IndexFlatIP(index.d)
+            delta.add(_delta_index.reconstruct_n(count - store.index.ntotal, total - count))
+        store.index, _delta_index = index, delta
+    _persist_current(store)
+    logger.info("FAISS index retrained on %d vectors", count)
+
+def _retrain_in_background(store):
     try:
-        os.makedirs(FAISS_DB_PATH, exist_ok=True)
-        _vectorstore.save_local(FAISS_DB_PATH)
-        print(f"[DEBUG] FAISS index saved to {FAISS_DB_PATH}")
+        _retrain(store)
     except Exception as e:
-        print(f"[WARN] Could not persist FAISS index: {e}")
+        logger.warning("Background FAISS retrain failed: %s", e)
 
-    return _vectorstore
+def add_documents(docs):
+    """Embed `docs` and append them to the delta index without a rebuild; returns their docstore ids."""
+    global _delta_index, _retrain_thread, _unsaved_adds
+    store = _vectorstore
+    if store is None:
+        raise RuntimeError("No index loaded; call load_index_for_sources first.")
+    if not docs:
+        return []
+    vectors = _embed_with_cache([d.page_content for d in docs], store.embedding_function, EMBEDDING_CACHE_MODEL)
+    ids = [str(uuid.uuid4()) for _ in docs]
+    with _update_lock:
+        # Only the small flat delta is written; the trained main index is left as is
+        if _delta_index is None:
+            _delta_index = faiss.IndexFlatIP(vectors.shape[1])
+        store.docstore.add(dict(zip(ids, docs)))
+        start = len(store.index_to_docstore_id)
+        store.index_to_docstore_id.update({start + i: doc_id for i, doc_id in enumerate(ids)})
+        _delta_index.add(vectors)
+        _unsaved_adds += len(docs)
+        retrain = _delta_index.ntotal > INCREMENTAL_REBUILD_RATIO * store.index.ntotal
+        # A retrain saves when it swaps in; otherwise save once enough adds are pending
+        save = not retrain and _unsaved_adds >= PERSIST_EVERY_ADDS
+        if retrain and (_retrain_thread is None or not _retrain_thread.is_alive()):
+            _retrain_thread = threading.Thread(target=_retrain_in_background, args=(store,), daemon=True)
+            _retrain_thread.start()
+    if save:
+        _persist_current(store)
+    logger.debug("Added %d documents to the delta index", len(docs))
+    return ids
+
+def test_auto_index_build():
+    # "auto" switches to IVF-PQ at FAISS_IVF_PQ_MIN_VECTORS; build one that large end to end
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((max(FAISS_IVF_PQ_MIN_VECTORS, 10000), EMBEDDING_DIMENSIONS), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    index = _new_faiss_index(vectors, index_type="auto")
+    ivf = _ivf_of(index)
+    assert isinstance(ivf, faiss.IndexIVFPQ), type(ivf)
+    assert ivf.use_precomputed_table == -1
+    index.add(vectors)
+    _, ids = index.search(vectors[:5], 1)
+    logger.info("auto index: %s over %d vectors, nprobe=%d, top ids %s",
+                type(ivf).__name__, index.ntotal, ivf.nprobe, ids.ravel().tolist())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+    test_auto_index_build()
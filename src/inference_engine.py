@@ -1,12 +1,48 @@
+import re
+import functools
+
+try:  # optional: C Aho-Corasick automaton for the keyword scan
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# (keywords, decision) in priority order: when several match, the earliest rule wins
+_RULES = [
+    (("discount",), "This qualifies for a standard 10% discount if criteria met."),
+    (("decline", "risk"), "This might need to be declined or referred."),
+    (("refer", "unclear"), "Referring this case internally for further underwriting."),
+    (("accept", "coverage"), "Coverage is within standard appetite. Proceeding to accept."),
+]
+DEFAULT_DECISION = "Need more details. Referring this to underwriter."
+
+# keyword -> bit of the rule it belongs to (bit 0 = highest priority)
+_KEYWORD_BITS = {keyword: 1 << rank for rank, (keywords, _) in enumerate(_RULES) for keyword in keywords}
+# decision for a bitmask's lowest set bit; index 0 (no bits) is the fallback
+_DECISIONS = [DEFAULT_DECISION] + [decision for _, decision in _RULES]
+
+def _build_matcher():
+    """Return fn(text) yielding the rule bit of every keyword occurrence, in one pass over text."""
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for keyword, bit in _KEYWORD_BITS.items():
+            automaton.add_word(keyword, bit)
+        automaton.make_automaton()
+        return lambda text: (bit for _, bit in automaton.iter(text))
+    # Fallback: one alternation regex; the lookahead lets overlapping keywords all match
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, _KEYWORD_BITS)) + "))")
+    return lambda text: (_KEYWORD_BITS[m.group(1)] for m in pattern.finditer(text))
+
+_match_bits = _build_matcher()
+
 def infer_decision(question):
-    question = question.lower()
-    if "discount" in question:
-        return "This qualifies for a standard 10% discount if criteria met."
-    elif "decline" in question or "risk" in question:
-        return "This might need to be declined or referred."
-    elif "refer" in question or "unclear" in question:
-        return "Referring this case internally for further underwriting."
-    elif "accept" in question or "coverage" in question:
-        return "Coverage is within standard appetite. Proceeding to accept."
-    else:
-        return "Need more details. Referring this to underwriter."
+    # Matching is case-insensitive, so normalise before the cache to let "Discount?" and
+    # "discount?" share an entry
+    return _decide(question.lower())
+
+@functools.lru_cache(maxsize=4096)
+def _decide(question):
+    mask = 0
+    for bit in _match_bits(question):
+        mask |= bit
+    # Lowest set bit = highest-priority rule that matched, without comparing ranks per hit
+    return _DECISIONS[(mask & -mask).bit_length()]
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+import faiss
+import numpy as np
+
+class LRUCache:
+    """Small thread-safe LRU mapping; maxsize <= 0 disables it."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SemanticCache:
+    """Reuse a response when a new query embedding is within `threshold` cosine of a cached one.
+
+    Keeps up to `max_entries` recent (unit query vector, response) pairs in a flat inner-product
+    index; 1-NN lookup over <=1000 vectors is microseconds.
+    """
+
+    def __init__(self, max_entries, threshold):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._vectors = []
+        self._responses = []
+        self._index = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vec):
+        vec = np.asarray(vec, dtype=np.float32).reshape(1, -1).copy()
+        faiss.normalize_L2(vec)
+        return vec
+
+    def lookup(self, qvec):
+        if self.max_entries <= 0:
+            return None
+        q = self._unit(qvec)
+        with self._lock:
+            if self._index is None or self._index.ntotal == 0 or self._index.d != q.shape[1]:
+                return None
+            scores, ids = self._index.search(q, 1)
+            if ids[0][0] >= 0 and scores[0][0] >= self.threshold:
+                return self._responses[ids[0][0]]
+        return None
+
+    def add(self, qvec, response):
+        if self.max_entries <= 0:
+            return
+        q = self._unit(qvec)
+        with self._lock:
+            if self._index is None or self._index.d != q.shape[1]:
+                self._index = faiss.IndexFlatIP(q.shape[1])
+                self._vectors, self._responses = [], []
+            self._vectors.append(q[0])
+            self._responses.append(response)
+            self._index.add(q)
+            if len(self._responses) > self.max_entries:
+                # Evict the oldest half in one rebuild rather than shifting ids per insert
+                keep = max(1, self.max_entries // 2)
+                self._vectors = self._vectors[-keep:]
+                self._responses = self._responses[-keep:]
+                self._index.reset()
+                if self._vectors:
+                    self._index.add(np.vstack(self._vectors))
+
+    def clear(self):
+        with self._lock:
+            self._vectors, self._responses = [], []
+            self._index = None
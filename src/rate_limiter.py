@@ -0,0 +1,94 @@
+import os
+import time
+import logging
+import threading
+
+try:  # optional: share the LLM limit across worker processes
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Minimum spacing between LLM calls (seconds) and how many calls may burst back-to-back
+MIN_LLM_INTERVAL = float(os.getenv("MIN_LLM_INTERVAL", 1.0))
+LLM_BURST = int(os.getenv("LLM_BURST", 1))
+# When set, the LLM limit is enforced in Redis so every worker draws from the same budget
+LLM_LIMITER_REDIS_URL = os.getenv("LLM_LIMITER_REDIS_URL", "")
+
+class TokenBucket:
+    """Thread-safe in-process token bucket: `rate` tokens/second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Take `amount` tokens, sleeping only if the bucket can't cover them yet."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount  # reserve now; a negative balance queues later callers behind us
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+class RedisWindowLimiter:
+    """At most `limit` units per `window` seconds across all processes, via Redis INCRBY + PEXPIRE.
+
+    Windows are keyed off the Redis server clock so workers on different hosts agree on them.
+    If Redis becomes unreachable, callers fall back to `fallback` (an in-process bucket).
+    """
+
+    def __init__(self, client, limit, window, key="agentverse:llm", fallback=None):
+        self.client = client
+        self.limit = limit
+        self.window = window
+        self.key = key
+        self.fallback = fallback
+
+    def acquire(self, amount=1):
+        window_ms = int(self.window * 1000)
+        while True:
+            try:
+                seconds, micros = self.client.time()
+                now_ms = seconds * 1000 + micros // 1000
+                slot = now_ms // window_ms
+                key = f"{self.key}:{slot}"
+                pipe = self.client.pipeline()
+                pipe.incrby(key, amount)
+                pipe.pexpire(key, window_ms * 2)
+                count, _ = pipe.execute()
+            except Exception as e:
+                logger.warning("Redis rate limiter unavailable (%s); limiting in-process.", e)
+                if self.fallback is not None:
+                    self.fallback.acquire(amount)
+                return
+            if count <= self.limit:
+                return
+            time.sleep(((slot + 1) * window_ms - now_ms) / 1000.0)
+
+def per_minute_bucket(limit):
+    """Bucket enforcing `limit` units/minute (smoothed to one second of burst), or None if limit <= 0."""
+    if limit <= 0:
+        return None
+    rate = limit / 60.0
+    return TokenBucket(rate=rate, capacity=max(1.0, rate))
+
+def make_llm_limiter():
+    """Limiter for LLM calls built from env config, or None when limiting is disabled."""
+    if MIN_LLM_INTERVAL <= 0:
+        return None
+    burst = max(1, LLM_BURST)
+    local = TokenBucket(rate=1.0 / MIN_LLM_INTERVAL, capacity=burst)
+    if LLM_LIMITER_REDIS_URL:
+        if redis is None:
+            logger.warning("LLM_LIMITER_REDIS_URL is set but redis is not installed; limiting in-process.")
+        else:
+            client = redis.Redis.from_url(LLM_LIMITER_REDIS_URL)
+            return RedisWindowLimiter(client, limit=burst, window=MIN_LLM_INTERVAL * burst, fallback=local)
+    return local
@@ -0,0 +1,64 @@
+import numpy as np
+
+try:  # optional: JIT the selection loop when numba is installed
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+def _mmr_loops(sim_q, dvecs, lam, k):
+    # Greedy MMR over unit vectors; finite sentinels keep fastmath's no-inf assumption valid
+    n, d = dvecs.shape
+    selected = np.empty(k, dtype=np.int64)
+    taken = np.zeros(n, dtype=np.bool_)
+    max_red = np.full(n, -2.0)  # cosine similarity to the closest already-selected doc
+    for s in range(k):
+        best = -1
+        best_score = -1e30
+        for i in range(n):
+            if taken[i]:
+                continue
+            red = max_red[i] if s > 0 else 0.0
+            score = lam * sim_q[i] - (1.0 - lam) * red
+            if score > best_score:
+                best_score = score
+                best = i
+        selected[s] = best
+        taken[best] = True
+        for i in prange(n):
+            sim = 0.0
+            for j in range(d):
+                sim += dvecs[i, j] * dvecs[best, j]
+            if sim > max_red[i]:
+                max_red[i] = sim
+    return selected
+
+def _mmr_numpy(sim_q, dvecs, lam, k):
+    selected = np.empty(k, dtype=np.int64)
+    max_red = np.zeros(len(dvecs))
+    taken = np.zeros(len(dvecs), dtype=bool)
+    for s in range(k):
+        scores = lam * sim_q - (1.0 - lam) * max_red
+        scores[taken] = -np.inf
+        best = int(np.argmax(scores))
+        selected[s] = best
+        taken[best] = True
+        red = dvecs @ dvecs[best]
+        max_red = red if s == 0 else np.maximum(max_red, red)
+    return selected
+
+_mmr_kernel = njit(parallel=True, fastmath=True, cache=True)(_mmr_loops) if njit else _mmr_numpy
+
+def mmr(qvec, dvecs, lam=0.5, k=6):
+    """Indices (best first) of up to `k` rows of `dvecs` chosen by maximal marginal relevance.
+
+    `lam` trades relevance to `qvec` (1.0) against diversity among the picks (0.0).
+    """
+    dvecs = np.ascontiguousarray(dvecs, dtype=np.float32)
+    k = min(k, len(dvecs))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    qvec = np.asarray(qvec, dtype=np.float32)
+    dvecs = dvecs / (np.linalg.norm(dvecs, axis=1, keepdims=True) + 1e-12)
+    qvec = qvec / (np.linalg.norm(qvec) + 1e-12)
+    sim_q = (dvecs @ qvec).astype(np.float64)
+    return _mmr_kernel(sim_q, dvecs, float(lam), k)